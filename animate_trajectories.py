@@ -1,6 +1,6 @@
 import argparse
-from skimage import io
 from src.particle_tracking import calculate_trajectories
+from src.video import LazyFrameStack
 from src.plotting import animate_trajectories
 
 def main():
@@ -24,11 +24,11 @@ def main():
             - output_filename: {output_filename}
             """)
 
-    frames = io.imread(video)
-    image_size = frames[0].shape
-
-    trajectories, _, _ = calculate_trajectories(frames, 1, max_distance=max_distance)
-    animate_trajectories(trajectories, frames, video, image_size, background=enable_background, filename=output_filename)
+    # Frames are only read from disk while they are processed
+    with LazyFrameStack(video) as frames:
+        image_size = frames.shape[1:]
+        trajectories, _, _ = calculate_trajectories(frames, 1, max_distance=max_distance)
+        animate_trajectories(trajectories, frames, video, image_size, background=enable_background, filename=output_filename)
 
 if __name__ == "__main__":
    main()
\ No newline at end of file
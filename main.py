@@ -1,6 +1,6 @@
 import argparse
-from skimage import io
 from src.particle_tracking import calculate_trajectories, calculate_particle_radii, approximate_avogadros_number
+from src.video import LazyFrameStack
 from src.plotting import plot_trajectories, plot_MSD
 
 def main():
@@ -38,10 +38,11 @@ def main():
           - save_plots: {save_plots}
         """)
 
-    frames = io.imread(video)
-    image_size = frames[0].shape
+    # Frames are only read from disk while they are processed
+    with LazyFrameStack(video) as frames:
+        image_size = frames.shape[1:]
+        trajectories, _, squared_displacements = calculate_trajectories(frames, ratio, max_distance=max_distance)
 
-    trajectories, _, squared_displacements = calculate_trajectories(frames, ratio, max_distance=max_distance)
     plot_trajectories(trajectories, image_size, video, save_plot=save_plots)
     plot_MSD(squared_displacements, video, framerate, save_plot=save_plots)
     radii = calculate_particle_radii(squared_displacements, framerate, temperature, dynamic_viscosity, BOLTZMANN_CONSTANT)
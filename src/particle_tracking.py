@@ -1,150 +1,360 @@
+import cv2
+import os
+import threading
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from timeit import default_timer as timer
 from datetime import timedelta
-from skimage.measure import label, regionprops
+from numba import njit, prange
+from scipy.spatial import cKDTree
 
-def _frames_to_black_and_white(frames, threshold=200):
-    """Converts all frames to black (0) and white (255) pixels only.
+# Up to this number of particle pairs per frame a brute force search is cheaper than building a k-d tree
+_MAX_BRUTE_FORCE_PAIRS = 65536
+
+# Below this number of tracked particles the transfers to the GPU cost more than they save
+_MIN_GPU_PARTICLES = 2000
+
+# Maximum number of pairwise distances computed at once on the GPU (256 MB in float32)
+_MAX_GPU_DISTANCES = 2 ** 26
+
+# Number of nearest particles found on the GPU among which the nearest one is chosen with exact distances
+_GPU_NEAREST_CANDIDATES = 4
+
+# Per-thread scratch buffers for the particle extraction
+_thread_local = threading.local()
+
+def _frame_particle_centers(frame, threshold):
+    """Calculates the coordinates of the particle centers in a single frame.
+
+    Parameters
+    ----------
+    frame : array
+        The frame from which to extract the particle centers.
+    threshold : int
+        The cutoff brightness of pixels. Everything above belongs to a particle, everything below to the background.
+    """
+    # Mask and label image reused for all frames handled by this thread. Labeling the whole stack as one volume
+    # (with a structure that does not connect frames) was tried, but it needs a label image as large as the video
+    # and was not faster.
+    labeled_components = getattr(_thread_local, 'labeled_components', None)
+    if labeled_components is None or labeled_components.shape != frame.shape:
+        labeled_components = _thread_local.labeled_components = np.empty(frame.shape, dtype=np.int32)
+        _thread_local.binary_frame = np.empty(frame.shape, dtype=bool)
+    binary_frame = _thread_local.binary_frame
+
+    # The boolean mask is handed to OpenCV as 0/1 bytes without copying
+    np.greater_equal(frame, threshold, out=binary_frame)
+    # Pixels touching at edges or corners belong to the same particle. Label 0 is the background.
+    _, _, _, centroids = cv2.connectedComponentsWithStatsWithAlgorithm(
+        binary_frame.view(np.uint8), 8, cv2.CV_32S, cv2.CCL_GRANA, labels=labeled_components)
+
+    # Centroids are already given as (x, y)
+    return centroids[1:]
+
+
+def _extract_particle_centers(frames, threshold=200):
+    """Generates coordinates of centers of particles in the image sequence.
+
+    Returns the x and y coordinates as two arrays of shape (frames, max. particles), padded with NaN,
+    and the number of particles in each frame.
+
+    Thresholding, labeling and the centroid calculation are done frame by frame in one pass,
+    so every frame is only read once while it is still in cache. The frames are processed in parallel,
+    each worker reads (and decodes) the frames it labels, so only one frame per worker is loaded at a time.
 
     If the argument `threshold` isn't passed in, the default threshold
     of 200 is used.
 
     Parameters
     ----------
-    frames : array
-        Array of frames which should be converted.
+    frames : array / LazyFrameStack
+        Array of frames from which to extract the particle centers.
     threshold : int, optional
-        The cutoff brightness of pixels. Everything below will be turned black (0), everything above white (255).
+        The cutoff brightness of pixels. Everything above belongs to a particle, everything below to the background.
     """
     start_time = timer()
 
-    for frame in frames:
-        threshold_indices = frame < threshold
-        frame[threshold_indices] = 0
+    num_workers = os.cpu_count() or 1
 
-        threshold_indices = frame >= threshold
-        frame[threshold_indices] = 255
+    def frame_particle_centers(image_idx):
+        # Reading the frame in the worker overlaps decoding it with the labeling of other frames
+        return _frame_particle_centers(frames[image_idx], threshold)
+
+    # Frames are independent of each other, the decoders, OpenCV and NumPy release the GIL while working on them
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        particle_sequence = list(executor.map(frame_particle_centers, range(len(frames))))
+
+    particle_counts = np.array([len(particles) for particles in particle_sequence], dtype=np.int32)
+    max_num_particles = particle_counts.max(initial=0)
+
+    # Store the coordinates as contiguous arrays instead of one small array per frame
+    particle_x = np.full((len(particle_sequence), max_num_particles), np.nan, dtype=np.float32)
+    particle_y = np.full_like(particle_x, np.nan)
+    for image_idx, particles in enumerate(particle_sequence):
+        particle_x[image_idx, :len(particles)] = particles[:, 0]
+        particle_y[image_idx, :len(particles)] = particles[:, 1]
 
     end_time = timer()
 
-    print(f"[INFO] Converted all frames to black and white pixels only. [Execution Time: {timedelta(seconds=end_time-start_time)}]")
+    print(f"[INFO] Calculated coordinates of particles. [Execution Time: {timedelta(seconds=end_time-start_time)}]")
+    print(f"[INFO] Maximal particle number in the frame sequence is {max_num_particles}.")
+    
+    return particle_x, particle_y, particle_counts
 
-    return frames
 
+@njit(fastmath=True, boundscheck=False, cache=True)
+def _find_nearest_particle(current_x, current_y, next_x, next_y, next_count, max_squared_distance):
+    """Finds the particle of the next frame which is nearest to the current coordinates.
 
-def _extract_particle_centers(frames):
-    """Generates coordinates of centers of particles in the image sequence.
+    Returns the index of the nearest particle (-1 if no particle is closer than the maximum distance)
+    and its squared distance. Squared distances are compared to avoid the square root, the minimum
+    is updated without branching.
 
     Parameters
     ----------
-    frames : array
-        Array of frames from which to extract the particle centers.
+    current_x : float
+        Current x coordinate of the particle.
+    current_y : float
+        Current y coordinate of the particle.
+    next_x : array
+        Array with the x coordinates of the particles in the next frame.
+    next_y : array
+        Array with the y coordinates of the particles in the next frame.
+    next_count : int
+        Number of particles in the next frame.
+    max_squared_distance : float
+        The squared maximum distance a particle will move during one timestep (between two frames).
     """
-    start_time = timer()
+    min_squared_distance = max_squared_distance
+    nearest_idx = -1
+    for j in range(next_count):
+        dx = next_x[j] - current_x
+        dy = next_y[j] - current_y
+        squared_distance = dx * dx + dy * dy
+        closer = squared_distance < min_squared_distance
+        min_squared_distance = closer * squared_distance + (1 - closer) * min_squared_distance
+        nearest_idx = closer * j + (1 - closer) * nearest_idx
 
-    particle_sequence = []
-    max_num_particles = 0
+    return nearest_idx, min_squared_distance
 
-    for frame in frames:
-        particles = []
 
-        labeled_components = label(frame)
-        regions = regionprops(labeled_components)
-        if len(regions) > max_num_particles: max_num_particles = len(regions)
-   
-        for blob in regions:
-            y, x = blob.centroid
-            particles.append([x,y])
-        
-        particle_sequence.append(particles)
+@njit(parallel=True, cache=True)
+def _track_particles_brute_force(particle_x, particle_y, particle_counts, max_distance, pixel_micrometer_ratio):
+    """Tracks the particles of the first frame by comparing them with all particles of the next frame.
 
-    end_time = timer()
+    The particles are tracked independently of each other in parallel.
 
-    print(f"[INFO] Calculated coordinates of particles. [Execution Time: {timedelta(seconds=end_time-start_time)}]")
-    print(f"[INFO] Maximal particle number in the frame sequence is {max_num_particles}.")
-    
-    return particle_sequence, max_num_particles
+    Parameters
+    ----------
+    particle_x : array
+        Array of shape (frames, max. particles) with the x coordinates of the particles in each frame.
+    particle_y : array
+        Array of shape (frames, max. particles) with the y coordinates of the particles in each frame.
+    particle_counts : array
+        Number of particles in each frame, the remaining columns of `particle_x` and `particle_y` are padding.
+    max_distance : int
+        The maximum distance a particle will move during one timestep (between two frames).
+    pixel_micrometer_ratio : float
+        The ratio of pixels to micrometers.
+    """
+    num_particles = particle_counts[0]
+    sequence_length = particle_x.shape[0]
+    distances = np.zeros((num_particles, sequence_length - 2), dtype=np.float32)
+    trajectories = np.zeros((num_particles, sequence_length - 1, 2), dtype=np.float32)
+    max_squared_distance = max_distance ** 2
+
+    for i in prange(num_particles):
+        current_x = particle_x[0, i]
+        current_y = particle_y[0, i]
+        trajectories[i, 0, 0] = current_x
+        trajectories[i, 0, 1] = current_y
+
+        for image_idx in range(1, sequence_length - 1):
+            next_idx = image_idx + 1
+            # Go through all particles of the next image
+            nearest_idx, min_squared_distance = _find_nearest_particle(
+                current_x, current_y, particle_x[next_idx], particle_y[next_idx], particle_counts[next_idx], max_squared_distance)
+
+            if nearest_idx >= 0:
+                distances[i, image_idx - 1] = np.sqrt(min_squared_distance) * pixel_micrometer_ratio
+                current_x = particle_x[next_idx, nearest_idx]
+                current_y = particle_y[next_idx, nearest_idx]
+            else:
+                # Particle might be out of the image, save NaN and don't override coordinates
+                distances[i, image_idx - 1] = np.nan
+
+            trajectories[i, image_idx, 0] = current_x
+            trajectories[i, image_idx, 1] = current_y
+
+    return trajectories, distances
 
 
-def _calc_dist(point1, point2):
-    """Calculates the distance between two points in 2D space.
+def _track_particles_kd_tree(particle_x, particle_y, particle_counts, max_distance, pixel_micrometer_ratio):
+    """Tracks the particles of the first frame by querying a k-d tree of the next frame.
+
+    All tracked particles are matched at once, frame by frame.
 
     Parameters
     ----------
-    point1 : array
-        Array with x and y coordinate of first point.
-    point2 : array
-        Array with x and y coordinate of second point.
+    particle_x : array
+        Array of shape (frames, max. particles) with the x coordinates of the particles in each frame.
+    particle_y : array
+        Array of shape (frames, max. particles) with the y coordinates of the particles in each frame.
+    particle_counts : array
+        Number of particles in each frame, the remaining columns of `particle_x` and `particle_y` are padding.
+    max_distance : int
+        The maximum distance a particle will move during one timestep (between two frames).
+    pixel_micrometer_ratio : float
+        The ratio of pixels to micrometers.
     """
-    return (np.sqrt((point2[0] - point1[0] )**2 + (point2[1] - point1[1]) ** 2))
+    # Get number of particles in first frame (as Python int, so products with it cannot overflow)
+    num_particles = int(particle_counts[0])
+    # Get sequence length
+    sequence_length = len(particle_counts)
+    # Create array for distances and trajectories
+    distances = np.zeros(shape=(num_particles, sequence_length - 2), dtype=np.float32)
+    trajectories = np.zeros(shape=(num_particles, sequence_length - 1, 2), dtype=np.float32)
+
+    # Coordinates of all tracked particles, updated frame by frame
+    current_coordinates = np.column_stack((particle_x[0, :num_particles], particle_y[0, :num_particles]))
+    trajectories[:, 0] = current_coordinates
 
+    # Go through all the images
+    for image_idx in range(1, sequence_length - 1):
+        next_count = particle_counts[image_idx + 1]
+        next_particles = np.column_stack((particle_x[image_idx + 1, :next_count], particle_y[image_idx + 1, :next_count]))
+        # Find the nearest particle of the next image for all tracked particles at once
+        if len(next_particles) > 0:
+            min_distances, next_indices = cKDTree(next_particles).query(current_coordinates, k=1, distance_upper_bound=max_distance)
+        else:
+            min_distances, next_indices = np.full(num_particles, np.inf), np.zeros(num_particles, dtype=int)
+        found = min_distances < max_distance
 
-def calculate_trajectories(frames, pixel_micrometer_ratio, max_distance=50):
+        # Override current coordinates of found particles, the others might be out of the image
+        current_coordinates[found] = next_particles[next_indices[found]]
+        # Save distances (NaN if the particle was not found)
+        distances[:, image_idx - 1] = np.where(found, min_distances * pixel_micrometer_ratio, np.nan)
+        trajectories[:, image_idx] = current_coordinates
+
+    return trajectories, distances
+
+
+def _track_particles_torch(particle_x, particle_y, particle_counts, max_distance, pixel_micrometer_ratio, device='cuda'):
+    """Tracks the particles of the first frame on the GPU by computing the distances to all particles of the next frame.
+
+    All tracked particles are matched frame by frame, in blocks of particles so the distance
+    matrices fit into GPU memory. Requires PyTorch.
+
+    If the argument `device` isn't passed in, the default CUDA device is used.
+
+    Parameters
+    ----------
+    particle_x : array
+        Array of shape (frames, max. particles) with the x coordinates of the particles in each frame.
+    particle_y : array
+        Array of shape (frames, max. particles) with the y coordinates of the particles in each frame.
+    particle_counts : array
+        Number of particles in each frame, the remaining columns of `particle_x` and `particle_y` are padding.
+    max_distance : int
+        The maximum distance a particle will move during one timestep (between two frames).
+    pixel_micrometer_ratio : float
+        The ratio of pixels to micrometers.
+    device : str, optional
+        The PyTorch device to run the tracking on.
+    """
+    import torch
+
+    # Get number of particles in first frame
+    num_particles = int(particle_counts[0])
+    # Get sequence length
+    sequence_length = len(particle_counts)
+
+    # Center the coordinates on the frame. The distances are computed as a matrix product, which loses
+    # precision in float32 for coordinates far from the origin.
+    center = np.array([(np.nanmin(particle_x) + np.nanmax(particle_x)) / 2, (np.nanmin(particle_y) + np.nanmax(particle_y)) / 2], dtype=np.float32)
+    # Move all particle coordinates to the device once
+    particle_positions = torch.from_numpy(np.stack((particle_x, particle_y), axis=-1) - center).to(device)
+    distances = torch.full((num_particles, sequence_length - 2), float('nan'), device=device)
+    trajectories = torch.zeros((num_particles, sequence_length - 1, 2), device=device)
+
+    # Coordinates of all tracked particles, updated frame by frame
+    current_coordinates = particle_positions[0, :num_particles].clone()
+    trajectories[:, 0] = current_coordinates
+
+    # Go through all the images
+    for image_idx in range(1, sequence_length - 1):
+        next_particles = particle_positions[image_idx + 1, :particle_counts[image_idx + 1]]
+        if len(next_particles) > 0:
+            # Find the nearest candidates in the next image, only a block of the distance matrix is kept at once
+            block_size = max(1, _MAX_GPU_DISTANCES // len(next_particles))
+            num_candidates = min(_GPU_NEAREST_CANDIDATES, len(next_particles))
+            candidate_indices = torch.cat([torch.cdist(current_coordinates[start:start + block_size], next_particles).topk(num_candidates, dim=1, largest=False).indices
+                                           for start in range(0, num_particles, block_size)])
+            # Choose the nearest candidate by computing the distances directly, the matrix product can confuse particles at similar distances
+            candidate_distances = torch.linalg.vector_norm(next_particles[candidate_indices] - current_coordinates[:, None], dim=2)
+            min_distances, nearest_candidates = candidate_distances.min(dim=1)
+            next_indices = candidate_indices.gather(1, nearest_candidates[:, None]).squeeze(1)
+            found = min_distances < max_distance
+
+            # Override current coordinates of found particles, the others might be out of the image
+            current_coordinates = torch.where(found[:, None], next_particles[next_indices], current_coordinates)
+            distances[found, image_idx - 1] = min_distances[found] * pixel_micrometer_ratio
+        trajectories[:, image_idx] = current_coordinates
+
+    trajectories += torch.from_numpy(center).to(device)
+
+    return trajectories.cpu().numpy(), distances.cpu().numpy()
+
+
+def calculate_trajectories(frames, pixel_micrometer_ratio, max_distance=50, backend='cpu'):
     """Calculates the particle trajectories starting from the first frame. Also extracts the 
        distance and squared displacements of the particles from frame to frame.
 
         If the argument `max_distance` isn't passed in, the default distance of 50 is used.
+        If the argument `backend` isn't passed in, the trajectories are calculated on the CPU.
 
-        Note: This algorithm is not efficient! It is just a quick and dirty implementation, enough for the original purpose.
+        Note: Particles are matched greedily to their nearest neighbor in the next frame.
 
     Parameters
     ----------
-    frames : array
+    frames : array / LazyFrameStack
         Array of frames from which to extract the information from.
     pixel_micrometer_ratio : float
         The ratio of pixels to micrometers. Says how many micrometers are displayed by one pixel. 
         Used to calculate the distances and MSD in micrometers.
     max_distance : int, optional
         The maximum distance a particle will move during one timestep (between two frames).
+    backend : str, optional
+        Either 'cpu' or 'cuda'. With 'cuda' the trajectories are calculated on the GPU using PyTorch,
+        if there are more than 2000 particles to track.
     """
-    frames = _frames_to_black_and_white(frames)
-    particle_sequence, max_num_particles = _extract_particle_centers(frames)
+    if backend not in ('cpu', 'cuda'):
+        raise ValueError(f"Unknown backend '{backend}', expected 'cpu' or 'cuda'.")
+
+    particle_x, particle_y, particle_counts = _extract_particle_centers(frames)
+    max_num_particles = particle_x.shape[1]
 
     start_time = timer()
 
-    # Get number of particles in first frame
-    num_particles = len(particle_sequence[0])
-    # Get sequence length
-    sequence_length = len(particle_sequence)
-    # Create array for distances and trajectories
-    distances = np.zeros(shape=(num_particles, sequence_length - 2))
-    trajectories = np.zeros(shape=(num_particles, sequence_length - 1, 2))
-    squared_displacements = np.zeros(shape=(num_particles, sequence_length - 2))
-
-    # Iterate over the number of particles
-    for i in range(0, num_particles):
-        # Get current coordinates of particle
-        current_coordinates = particle_sequence[0][i]
-        # Go through all the images
-        for image_idx in range(1, sequence_length):
-            #print(f"[INFO] Particle {i}: {current_coordinates} [{image_idx}]")
-            trajectories[i][image_idx - 1] = current_coordinates
-            # Check for array out of bounce
-            if (image_idx + 1) >= sequence_length:
-                break
-            # Reset minimum distance
-            min_distance = 99999
-            # Reset next coordinates
-            next_coords = []
-            # Go through all particles of the next image
-            for j in range(0, len(particle_sequence[image_idx + 1])):
-                # Calculate the distance between both particles
-                distance = _calc_dist(current_coordinates, particle_sequence[image_idx + 1][j])
-                # If it lower than the current min distance, overwrite distance and next_coords
-                if distance < min_distance:
-                    min_distance = distance
-                    next_coords = particle_sequence[image_idx + 1][j]
-                
-            if min_distance < max_distance:
-                # Save distance in an array
-                distances[i][image_idx - 1] = min_distance * pixel_micrometer_ratio
-                # Override current coordinate of particle
-                current_coordinates = next_coords
-                # Save squared displacement of particle
-                squared_displacements[i][image_idx - 1] = (_calc_dist(current_coordinates, particle_sequence[0][i]) * pixel_micrometer_ratio) ** 2
-            else:
-                # Particle migth be out of the image, save None and don't overrite coordinates
-                distances[i][image_idx - 1] = None
+    # Get number of particles in first frame (as Python int, so products with it cannot overflow)
+    num_particles = int(particle_counts[0])
+
+    if backend == 'cuda' and num_particles <= _MIN_GPU_PARTICLES:
+        print(f"[INFO] Only {num_particles} particles to track, using the CPU instead of the GPU.")
+
+    if backend == 'cuda' and num_particles > _MIN_GPU_PARTICLES:
+        track_particles = _track_particles_torch
+    elif num_particles * max_num_particles <= _MAX_BRUTE_FORCE_PAIRS:
+        track_particles = _track_particles_brute_force
+    else:
+        track_particles = _track_particles_kd_tree
+
+    trajectories, distances = track_particles(particle_x, particle_y, particle_counts, max_distance, pixel_micrometer_ratio)
+
+    # Squared displacements from the starting point of each particle, left at 0 while a particle is not found
+    displacements = trajectories[:, 1:] - trajectories[:, :1]
+    squared_displacements = np.einsum('ijk,ijk->ij', displacements, displacements) * pixel_micrometer_ratio ** 2
+    squared_displacements[np.isnan(distances)] = 0
     
     end_time = timer() 
     print(f"[INFO] Calculated all {num_particles} particle trajectories. [Execution Time: {timedelta(seconds=end_time-start_time)}]")
@@ -192,13 +402,13 @@ def calculate_particle_radii(
     boltzmann_constant : float
         The value for the Boltzmann constant.
     """
-    times_in_s = np.array(range(1, len(squared_displacements[0]) + 1)) / video_fps
-    msd_in_micrometer = np.mean(squared_displacements, axis=0)  # Unit: µm^2
-    msd_in_meter = msd_in_micrometer * (10 ** (-12))            # Unit: m^2
-    diffusion_coefficient = msd_in_meter / (times_in_s * 4)     # Unit: m^2 / s
+    times_in_s = np.arange(1, len(squared_displacements[0]) + 1, dtype=np.float64) / video_fps     # Unit: s
+    msd_in_micrometer = np.mean(squared_displacements, axis=0, dtype=np.float64)  # Unit: µm^2
+    # MSD / (4 * t), the conversion from µm^2 to m^2 is part of the constant factor
+    diffusion_coefficient = msd_in_micrometer * ((10 ** (-12)) / 4) / times_in_s  # Unit: m^2 / s
     temperature_in_kelvin = _celsius_to_kelvin(temperature)      # Unit: K
 
-    radii = ((boltzmann_constant * temperature_in_kelvin) / (6 * np.pi * dynamic_viscosity * diffusion_coefficient))
+    radii = ((boltzmann_constant * temperature_in_kelvin) / (6 * np.pi * dynamic_viscosity)) / diffusion_coefficient
     mean_radius = np.mean(radii) * (10 ** 6)
     print(f"[INFO] Mean radius of particles of sample: {mean_radius} µm")
 
@@ -235,12 +445,13 @@ def approximate_avogadros_number(
         The value for the Boltzmann constant.
     """
 
-    times_in_s = np.array(range(1, len(squared_displacements[0]) + 1)) / video_fps
+    times_in_s = np.arange(1, len(squared_displacements[0]) + 1, dtype=np.float64) / video_fps     # Unit: s
     temperature_in_kelvin = _celsius_to_kelvin(temperature)      # Unit: K
-    msd_in_micrometer = np.mean(squared_displacements, axis=0)  # Unit: µm^2
-    msd_in_meter = msd_in_micrometer * (10 ** (-12))            # Unit: m^2
+    msd_in_micrometer = np.mean(squared_displacements, axis=0, dtype=np.float64)  # Unit: µm^2
 
-    avogadros_number = ((ideal_gas_constant * temperature_in_kelvin * times_in_s) / (3 * np.pi * dynamic_viscosity * radii * msd_in_meter))
+    # Constant part of the equation, including the conversion of the MSD from µm^2 to m^2
+    constant_factor = (ideal_gas_constant * temperature_in_kelvin) / (3 * np.pi * dynamic_viscosity * (10 ** (-12)))
+    avogadros_number = constant_factor * times_in_s / (radii * msd_in_micrometer)
     approx_avogadros_number = np.mean(avogadros_number)
 
     print(f"[INFO] Avogadro's Number (approximation): {approx_avogadros_number} mol-1")
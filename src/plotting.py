@@ -1,7 +1,11 @@
+import cv2
+import os
 import numpy as np
 import matplotlib.pyplot as plt
-import os
-import imageio
+from matplotlib.colors import to_rgb
+from PIL import Image, GifImagePlugin
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
 def plot_MSD(squared_displacements, video_title, video_fps=10, time_cutoff=1, save_plot=False):
@@ -28,8 +32,8 @@ def plot_MSD(squared_displacements, video_title, video_fps=10, time_cutoff=1, sa
     cutoff = int(len(squared_displacements[0]) * time_cutoff)
     squared_displacements = squared_displacements[:,:cutoff]
 
-    msd_in_micrometer = np.mean(squared_displacements, axis=0)
-    times = np.array(range(0, len(squared_displacements[0]))) / video_fps
+    msd_in_micrometer = np.mean(squared_displacements, axis=0, dtype=np.float64)
+    times = np.arange(len(squared_displacements[0]), dtype=np.float64) / video_fps
 
     plt.plot(times, msd_in_micrometer)
     plt.xlabel('time in s')
@@ -82,14 +86,69 @@ def plot_trajectories(trajectories, image_size, video_title, save_plot=False):
 
     print(f"[INFO] Plotted trajectories for all tracked particles.")
 
-def animate_trajectories(trajectories, frames, video_title, image_size, background=True, filename='animated_trajectory.gif', tmp_frame_folder='animated_frames'):
+def _gif_palette(colors):
+    """Build a fixed GIF palette containing the given colors and gray levels for the frames.
+
+    Parameters
+    ----------
+    colors : list
+        List of RGB tuples which should be part of the palette.
+    """
+    gray_levels = np.linspace(0, 255, 256 - len(colors)).astype(np.uint8)
+    palette = [value for color in colors for value in color] + [value for level in gray_levels for value in (level, level, level)]
+
+    palette_image = Image.new('P', (1, 1))
+    palette_image.putpalette(palette)
+    return palette_image
+
+def _write_gif(filename, frames, duration):
+    """Write palette images to a looping gif file, encoding each frame as soon as it is passed in.
+
+    All frames have to use the same palette, it is written once as the global palette of the file.
+    Only the region which changed since the previous frame is encoded.
+
+    Parameters
+    ----------
+    filename : str
+        Filename of the resulting gif file.
+    frames : iterable
+        Iterable of palette images ('P' mode) of the same size.
+    duration : int
+        Display time of each frame in milliseconds.
+    """
+    previous_indices = None
+    with open(filename, 'wb') as file:
+        for frame in frames:
+            indices = np.asarray(frame)
+            if previous_indices is None:
+                header, _ = GifImagePlugin.getheader(frame, info={'loop': 0, 'duration': duration})
+                file.writelines(header)
+                box = (0, 0, frame.width, frame.height)
+            else:
+                # Bounding box of the pixels which changed, a single pixel if nothing changed
+                changed = indices != previous_indices
+                rows = np.flatnonzero(changed.any(axis=1))
+                columns = np.flatnonzero(changed.any(axis=0))
+                box = (columns[0], rows[0], columns[-1] + 1, rows[-1] + 1) if len(rows) else (0, 0, 1, 1)
+            file.writelines(GifImagePlugin.getdata(frame.crop(box), offset=box[:2], duration=duration))
+            previous_indices = indices
+        # End of the gif file
+        file.write(b';')
+
+def animate_trajectories(trajectories, frames, video_title, image_size, background=True, filename='animated_trajectory.gif', fps=10):
     """Animate the evolution of the particles trajectories in a gif file.
 
+    The trajectories are drawn directly onto the image arrays with OpenCV, adding only the newest
+    segment of each trajectory per frame. The frames are quantized in parallel and streamed to
+    the gif file in order as they are finished.
+
+    If the argument `fps` isn't passed in, the default framerate of 10 is used.
+
     Parameters
     ----------
     trajectories : array
         Array containing the particle trajectories.
-    frames : array
+    frames : array / LazyFrameStack
         Array containing the frames of the original video file.
     video_title : str
         The title of the video / frame sequence which was converted. Only used to distinguish various plots.
@@ -99,39 +158,61 @@ def animate_trajectories(trajectories, frames, video_title, image_size, backgrou
         Enables plotting the trajectories on the original frames. If disable it will be on white background only.
     filename : str, optional
         Filename of the resulting gif file.
-    tmp_frame_folder : str, optional
-        Path of a temporary folder containing all the created frame files.
+    fps : int, optional
+        The framerate of the resulting gif file.
     """
-    # Setup folder for temporary files
-    dir_path = os.getcwd()
-    path = os.path.join(dir_path, tmp_frame_folder)
-    if not os.path.isdir(path):
-        os.mkdir(path)
-    # Draw trajectories on frames and save them seperately
-    for i in tqdm(range (len(trajectories[0])), desc='[INFO] Plotting...'):
+    # Use the same colors as the matplotlib plots
+    colors = [tuple(int(255 * value) for value in to_rgb(color)) for color in plt.rcParams['axes.prop_cycle'].by_key()['color']]
+    text_color = (255, 255, 255) if background else (0, 0, 0)
+    palette = _gif_palette(colors)
+
+    num_frames = len(trajectories[0])
+    num_workers = os.cpu_count() or 1
+    points = np.round(trajectories).astype(np.int32)
+
+    # Trajectories drawn so far (already multiplied by their opacity) and their opacity, kept between frames
+    trajectory_layer = np.zeros((image_size[0], image_size[1], 3), dtype=np.uint8)
+    trajectory_alpha = np.zeros((image_size[0], image_size[1]), dtype=np.uint8)
+
+    def draw_frame(i):
         # Take frame of video as background if set to true
         if background:
-            plt.imshow(frames[i], 'gray')
-        for trajectory in trajectories:
-            x, y = np.array(trajectory[0:i]).T
-            plt.plot(x, y) 
-        plt.xlim(0, image_size[1])
-        plt.ylim(0, image_size[0])
-        plt.xlabel('width in pixels')
-        plt.ylabel('height in pixels')
-        plt.title(f'Trajectories of tracked particles ({video_title})')
-        ax = plt.gca()
-        ax.set_aspect('equal', adjustable='box')
-        plt.gca().invert_yaxis()
-        # Save figure
-        plt.savefig(f"{path}/frame_{i}.png", bbox_inches='tight')
-        # Clear plot
-        plt.clf()
-
-    # Create gif file out of all created frames
-    with imageio.get_writer(filename, mode='I') as writer:
-        for i in tqdm(range (len(trajectories[0])), desc='[INFO] Creating GIF ...'):
-            image = imageio.imread(f"{path}/frame_{i}.png")
-            writer.append_data(image)
+            frame = frames[i]
+            if frame.dtype != np.uint8:
+                frame = cv2.normalize(frame, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
+            canvas = cv2.cvtColor(frame, cv2.COLOR_GRAY2RGB)
+        else:
+            canvas = np.full((image_size[0], image_size[1], 3), 255, dtype=np.uint8)
+        # Only the newest segment of each trajectory is drawn, the older ones are still on the layer
+        if i > 1:
+            for color_idx, color in enumerate(colors):
+                segments = np.ascontiguousarray(points[color_idx::len(colors), i - 2:i])
+                cv2.polylines(trajectory_layer, segments, isClosed=False, color=color, thickness=1, lineType=cv2.LINE_AA)
+                cv2.polylines(trajectory_alpha, segments, isClosed=False, color=255, thickness=1, lineType=cv2.LINE_AA)
+        # Put the trajectories on top of the background
+        transparency = cv2.cvtColor(255 - trajectory_alpha, cv2.COLOR_GRAY2RGB)
+        canvas = cv2.add(cv2.multiply(canvas, transparency, scale=1 / 255), trajectory_layer)
+        cv2.putText(canvas, f'Trajectories of tracked particles ({video_title})', (5, 15), cv2.FONT_HERSHEY_SIMPLEX, 0.4, text_color, 1, cv2.LINE_AA)
+        return canvas
+
+    def quantize(canvas):
+        # Map to the fixed palette, so the gif encoder does not need to compute a palette per frame
+        return Image.fromarray(canvas).quantize(palette=palette, dither=Image.Dither.NONE)
+
+    def draw_frames():
+        # Frames are drawn one after another, the quantization is done in parallel (OpenCV and Pillow
+        # release the GIL). The gif writer consumes the frames one by one, so at most 2 * num_workers
+        # frames are waiting to be written at any time.
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            pending = deque()
+            for i in range(num_frames):
+                pending.append(executor.submit(quantize, draw_frame(i)))
+                if len(pending) > 2 * num_workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    # Frames are written to the file one after another while the next ones are drawn
+    _write_gif(filename, tqdm(draw_frames(), total=num_frames, desc='[INFO] Creating GIF ...'), duration=round(1000 / fps))
 
     print("[INFO] Successfully created an animation of the particles trajectories.")
\ No newline at end of file
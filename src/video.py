@@ -0,0 +1,62 @@
+import numpy as np
+import tifffile
+
+class LazyFrameStack:
+    """Frames of a TIF video file which are only read from disk when they are accessed.
+
+    Can be used in place of an array containing all frames. Indexing with an integer
+    returns a single frame, indexing with a slice returns an array of the selected frames.
+    Frames can be read from several threads at once, only the reads from the file are
+    synchronized while the frames are decoded in parallel.
+
+    Parameters
+    ----------
+    path : str
+        Path of the TIF video file.
+    """
+    def __init__(self, path):
+        self._tif = tifffile.TiffFile(path)
+        # Use the lock of the file handle, tifffile holds it only while reading the compressed data
+        self._tif.filehandle.lock = True
+        self._lock = self._tif.filehandle.lock
+
+        first_page = self._tif.pages[0]
+        self.shape = (len(self._tif.pages),) + first_page.shape
+        self.dtype = first_page.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            frame_indices = range(*index.indices(len(self)))
+            frames = np.empty((len(frame_indices),) + self.shape[1:], dtype=self.dtype)
+            for i, frame_idx in enumerate(frame_indices):
+                frames[i] = self._read_frame(frame_idx)
+            return frames
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"Frame index {index} is out of range for a video with {len(self)} frames.")
+        return self._read_frame(index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._read_frame(i)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _read_frame(self, index):
+        # The page structure is parsed from the shared file handle, so only one thread may do it at a time
+        with self._lock:
+            page = self._tif.pages[index]
+        return page.asarray(lock=self._lock)
+
+    def close(self):
+        """Closes the underlying video file."""
+        self._tif.close()